@@ -0,0 +1,571 @@
+"""
+===============================================================================
+ Module Name  : ups_poller.py
+ Description  : Shared Modbus polling code for the Phoenix Contact TRIO UPS monitors.
+                Holds the register map, the bulk register reads, value formatting,
+                SOC estimation and the SOC trend graph, so UPS_monitor_PC.py and
+                UPS_Monitor_PC_MQTT.py only add their own outputs (CSV, MQTT).
+
+ Author       : MCI
+ Python       : 3.10+
+ Dependencies : pymodbus, numpy
+===============================================================================
+"""
+import sys
+import time
+import logging
+import logging.handlers
+import queue
+import threading
+import atexit
+import collections
+import socket
+import struct
+from pymodbus.client import ModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+import numpy as np
+
+RECONNECT_DELAY_MIN = 5  # seconds, doubled after every failed Modbus connect
+RECONNECT_DELAY_MAX = 60  # seconds
+
+# Linear SOC estimate from battery voltage: 20.4 V is 0%, 27.5 V is 100%
+_SOC_V_MIN = 20.4
+_SOC_INV_RANGE = 100.0 / (27.5 - _SOC_V_MIN)  # % per volt, so a SOC estimate needs no division
+
+# Define the Modbus registers we want to read: address -> (label, word count, unit, scale factor)
+# These are from the Phoenix Contact TRIO UPS documentation, no SOC register is available, so we estimate it based on battery voltage
+registers = {
+    0x2000: ("Status Functions", 4, None, None),
+    0x2002: ("Status Interface", 2, None, None),
+    0x2006: ("Output Voltage", 1, "V", 1000),
+    0x2007: ("Output Current", 1, "mA", 1),
+    0x200A: ("Battery Voltage", 1, "V", 1000),
+    0x200B: ("Battery Current", 1, "mA", 1),
+    0x200D: ("Battery Temperature", 1, "K", 1),
+    0x200E: ("Device Temperature", 1, "K", 1),
+    0x203C: ("Remaining Time PC Shutdown (t31)", 1, "min", 60),
+    0x2024: ("Battery Mode Time", 2, "min", 60),
+    0x2026: ("User Battery Mode Time", 2, "min", 60),
+    0x1064: ("Battery Capacity", 1, "100mAh", 10),
+    0x0010: ("Device Name", 2, "ASCII", None),
+}
+
+# Registers closer than MAX_READ_GAP are merged into one read, Modbus allows at most 125 registers per read.
+# An unused register costs 2 bytes in the response, an extra read a full round-trip, so the whole status
+# block 0x2000-0x203C is read at once and a poll takes 3 requests.
+MAX_READ_GAP = 32
+MAX_READ_COUNT = 125
+
+def build_read_groups(registers, max_gap=MAX_READ_GAP, max_count=MAX_READ_COUNT):
+    """Group nearby registers into (base, count, [(address, offset, word_count), ...]) bulk reads."""
+    groups = []
+    for address in sorted(registers):
+        word_count = registers[address][1]
+        if groups:
+            base, count, members = groups[-1]
+            if address - (base + count) <= max_gap and address + word_count - base <= max_count:
+                members.append((address, address - base, word_count))
+                groups[-1] = (base, max(count, address + word_count - base), members)
+                continue
+        groups.append((address, word_count, [(address, 0, word_count)]))
+    return groups
+
+READ_GROUPS = build_read_groups(registers)
+
+# Flags in Status Functions (0x2000), masks apply to the first two words packed into one 32-bit value with the
+# second word high, so bit numbers match the UPS manual: (key, bit mask, display label, text when set, text when not set)
+# The texts are the defaults for the console report, a monitor can pass its own (see Poller)
+# A new flag is one more line here
+STATUS_BITS = (
+    ("battery_mode", 1 << 2, "Battery Mode", "Active (Battery Mode)", "Inactive (Grid Power)"),  # Bit 2 (bit 2 in first word)
+    ("battery_present", 1 << 24, "Battery Present", "Yes", "No"),  # Bit 24 (bit 8 in second word)
+    ("temp_sensor_connected", 1 << 28, "Temperature Sensor", "Connected", "Not Connected"),  # Bit 28 (bit 12 in second word)
+)
+
+def decode_status_bits(status_functions):
+    """Return key -> bool for every flag in STATUS_BITS."""
+    status = (status_functions[1] << 16) | status_functions[0]  # manual bit order: second word is the high word
+    return {key: (status & mask) != 0 for key, mask, *_ in STATUS_BITS}
+
+def words_to_u32(values):
+    """Combine two registers (high word first) into one unsigned 32-bit value."""
+    return (values[0] << 16) | values[1]
+
+def decode_expression(word_count, unit, scale):
+    """Python expression turning the words v of one register into its value (Kelvin registers in °C).
+
+    This is the only place the conversion math is written, the decoders and the generated
+    decode_registers are both built from it. Returns None for ASCII registers.
+    """
+    divisor = scale or 1
+    if word_count == 1 and unit == "K":  # Kelvin to Celsius conversion
+        return f"v[0] / {divisor} - 273.15"
+    if unit == "ASCII":
+        return None
+    if word_count == 1:
+        return "v[0]" if divisor == 1 else f"v[0] / {divisor}"  # unscaled values stay integers
+    # For 2 or more words, high word first
+    return "(v[0] << 16) | v[1]" if divisor == 1 else f"((v[0] << 16) | v[1]) / {divisor}"
+
+def make_decoder(word_count, unit, scale):
+    """Build the function that turns the raw words of one register into its value (Kelvin registers in °C)."""
+    if unit == "ASCII":
+        # 2 chars per register, high byte first, packed to bytes in one struct call
+        packer = struct.Struct(f">{word_count}H")
+        def _dec_ascii(values):
+            return packer.pack(*values).strip(b'\x00').decode('ascii', errors='replace')
+        return _dec_ascii
+    return eval(f"lambda v: {decode_expression(word_count, unit, scale)}", {})
+
+def make_formatter(label, word_count, unit, scale):
+    """Build the formatter for one register, so unit/scale/word count are only looked at once at startup."""
+    prefix = f"{label:<35}: "
+    unit_str = unit or ''
+    decode = make_decoder(word_count, unit, scale)
+
+    if word_count == 1 and unit == "K":
+        def _fmt_kelvin(values):
+            return f"{prefix}{decode(values):.2f} °C (Raw: 0x{values[0]:04X})"
+        return _fmt_kelvin
+
+    if unit == "ASCII":
+        def _fmt_ascii(values):
+            return f"{prefix}{decode(values)}"
+        return _fmt_ascii
+
+    if word_count == 1:
+        def _fmt_scaled_u16(values):
+            return f"{prefix}{decode(values):.2f} {unit_str} (Raw: 0x{values[0]:04X})"
+        return _fmt_scaled_u16
+
+    # For 2 or more words
+    def _fmt_raw32(values):
+        return f"{prefix}{decode(values):.2f} {unit_str} (Raw: 0x{words_to_u32(values):08X})"
+    return _fmt_raw32
+
+# Built once at import: label -> value decoder (the generated decode_registers only calls it for ASCII
+# registers, the rest is inlined there) and label -> console line formatter
+DECODERS = {label: make_decoder(word_count, unit, scale)
+            for label, word_count, unit, scale in registers.values()}
+FORMATTERS = {label: make_formatter(label, word_count, unit, scale)
+              for label, word_count, unit, scale in registers.values()}
+
+# One descriptor per register that carries its prebuilt formatter, so loops over the
+# registers use named fields instead of unpacking tuples and looking up the formatter by label
+RegisterSpec = collections.namedtuple('RegisterSpec', 'address label word_count unit scale formatter')
+REGISTER_SPECS = tuple(RegisterSpec(address, label, word_count, unit, scale, FORMATTERS[label])
+                       for address, (label, word_count, unit, scale) in registers.items())
+
+def build_register_decoder(specs):
+    """Generate decode_registers(block_values, unavailable_addresses) for a fixed register map.
+
+    The register map does not change while running, so instead of looping over it and picking a decoder
+    per register, one straight-line function is generated with every register's conversion written inline.
+    It returns (label -> raw words, set of unavailable labels, label -> decoded value or None).
+    """
+    lines = [
+        "def decode_registers(block_values, unavailable_addresses):",
+        "    register_values = {}",
+        "    unavailable = set()",
+        "    results = {}",
+    ]
+    for spec in specs:
+        label = spec.label
+        address = spec.address
+        lines += [
+            f"    v = register_values[{label!r}] = block_values[{address:#06x}]",
+            "    if v is None:",
+            f"        results[{label!r}] = None",
+            f"        logging.error({f'Error reading register {label} (0x{address:04X})'!r})",
+            f"    elif {address:#06x} in unavailable_addresses:",
+            f"        results[{label!r}] = None",
+            f"        unavailable.add({label!r})",
+            "    else:",
+            f"        results[{label!r}] = {decode_expression(spec.word_count, spec.unit, spec.scale) or f'DECODERS[{label!r}](v)'}",
+        ]
+    lines.append("    return register_values, unavailable, results")
+    namespace = {"DECODERS": DECODERS, "logging": logging}
+    exec(compile("\n".join(lines), "<register decoder>", "exec"), namespace)
+    return namespace["decode_registers"]
+
+decode_registers = build_register_decoder(REGISTER_SPECS)
+
+class SOCRing:
+    """Fixed-size circular buffer of (timestamp, SOC) samples stored in two preallocated NumPy arrays.
+
+    Timestamps are time.monotonic() values, so they stay in order even when the wall clock is changed.
+    """
+
+    def __init__(self, capacity=600):
+        self.capacity = capacity
+        self.t = np.empty(capacity, dtype=np.float64)
+        self.s = np.empty(capacity, dtype=np.float64)
+        self.n = 0  # number of stored samples
+        self.head = 0  # index the next sample is written to
+
+    def __len__(self):
+        return self.n
+
+    def append(self, t, s):
+        """Store a sample, overwriting the oldest one once the buffer is full."""
+        self.t[self.head] = t
+        self.s[self.head] = s
+        self.head = (self.head + 1) % self.capacity
+        if self.n < self.capacity:
+            self.n += 1
+
+    def snapshot(self):
+        """Return (times, socs) arrays in chronological order."""
+        if self.n < self.capacity:
+            return self.t[:self.n], self.s[:self.n]
+        return (np.concatenate((self.t[self.head:], self.t[:self.head])),
+                np.concatenate((self.s[self.head:], self.s[:self.head])))
+
+GRAPH_COLS = 50
+GRAPH_ROWS = 10
+GRAPH_INTERVAL = 5  # seconds, the SOC graph is redrawn at most this often
+# The x axis of the SOC graph never changes, so it is built once
+_GRAPH_AXIS = ("      +" + "-" * GRAPH_COLS,
+               "       " + ''.join(str(i//5) if i % 5 == 0 else ' ' for i in range(GRAPH_COLS)))
+
+def print_soc_graph(soc_history, now=None):
+    """Print a simple ASCII graph showing State of Charge trend over last 10 minutes (ending at now, a time.monotonic() value)."""
+    if not soc_history:
+        print("SOC Trend: No data available")
+        return
+
+    times, socs = soc_history.snapshot()
+    if now is None:
+        now = time.monotonic()
+    window_start = now - 600  # last 10 minutes
+    # Samples are stored in time order, so the window is a tail slice found by binary search
+    relevant = socs[np.searchsorted(times, window_start, side='left'):]
+    if relevant.size == 0:
+        print("SOC Trend: No recent data")
+        return
+
+    min_soc = relevant.min()
+    max_soc = relevant.max()
+    if max_soc - min_soc < 5:
+        mid = (max_soc + min_soc) / 2
+        min_soc = mid - 2.5
+        max_soc = mid + 2.5
+
+    cols = GRAPH_COLS
+    rows = GRAPH_ROWS
+    # Average every chunk_size samples into one column, at most cols columns
+    chunk_size = max(1, len(relevant) // cols)
+    n_cols = min(cols, len(relevant) // chunk_size)
+    avg_socs = relevant[:n_cols * chunk_size].reshape(n_cols, chunk_size).mean(axis=1)
+
+    # One comparison for the whole graph: grid[r, c] is True when column c reaches the threshold of row r
+    thresholds = min_soc + (max_soc - min_soc) * (np.arange(rows, -1, -1) / rows)
+    grid = avg_socs[None, :] >= thresholds[:, None]
+    bars = np.where(grid, '█', ' ').tolist()  # plain str lists, joining NumPy str scalars is much slower
+
+    # Collect the lines and print the graph with a single write
+    lines = ["\nSOC Trend (Last 10 minutes):"]
+    lines.extend(f"{threshold:5.1f}% | " + ''.join(row) for threshold, row in zip(thresholds, bars))
+    lines.extend(_GRAPH_AXIS)
+    lines.append("")
+    print("\n".join(lines))
+
+def setup_logging(filename='modbus_errors.log', capacity=100):
+    """Log to filename through a queue, a background listener thread does the actual file writes.
+
+    The listener hands records to a MemoryHandler: INFO records are written in batches of capacity,
+    a WARNING or worse writes the batch (and itself) right away.
+    """
+    log_queue = queue.Queue(-1)
+    log_file_handler = logging.FileHandler(filename)
+    log_file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    log_buffer = logging.handlers.MemoryHandler(capacity, flushLevel=logging.WARNING, target=log_file_handler)
+    log_listener = logging.handlers.QueueListener(log_queue, log_buffer, respect_handler_level=True)
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener.start()
+    # On exit (last registered runs first) the listener drains the queue, then the buffer is written
+    atexit.register(log_buffer.close)
+    atexit.register(log_listener.stop)
+    return log_listener
+
+class CSVWriterThread:
+    """Appends text rows to a CSV file from a background thread, so the poll loop never waits for the disk."""
+
+    def __init__(self, filename, buffering=8192, batch_size=50, maxsize=1024):
+        # One file handle for the whole run, mode 'a' opens it with O_APPEND so every write goes to the end of the file
+        self.file = open(filename, mode='a', newline='', buffering=buffering)
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._run, name="csv-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # write the queued rows and close the file on exit
+
+    def write(self, row):
+        """Queue one row (a line of text ending in a newline), dropped with a warning if the writer fell behind."""
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            logging.warning("CSV writer queue full, row dropped")
+
+    def close(self):
+        """Stop the thread after it wrote everything queued so far, the thread then closes the file."""
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=5)
+            except queue.Full:
+                # Queue full and the thread not taking rows (e.g. a stalled disk), do not hang the exit
+                logging.warning("CSV writer is stalled, rows still queued may be lost")
+                return
+            self.thread.join(timeout=5)
+            if self.thread.is_alive():
+                # Still writing (e.g. a stalled disk), leave the file to the thread instead of closing it under it
+                logging.warning("CSV writer did not stop in time, rows still queued may be lost")
+        else:
+            self.file.close()
+
+    def _run(self):
+        try:
+            running = True
+            while running:
+                # Wait for a row, then take whatever else is queued (up to batch_size) and write it in one go
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:  # stop marker from close()
+                    batch = batch[:batch.index(None)]
+                    running = False
+                try:
+                    self.file.writelines(batch)
+                    self.file.flush()
+                except OSError as e:
+                    logging.error(f"Writing CSV rows failed: {e}")
+        finally:
+            # Only this thread writes the file, so it is also the one that closes it
+            self.file.close()
+
+def enable_tcp_nodelay(client):
+    """Disable Nagle on the Modbus socket so small requests are sent immediately, returns True on success."""
+    # The sync client keeps its socket in client.socket, other pymodbus versions use a transport object
+    sock = getattr(client, "socket", None)
+    if sock is None:
+        transport = getattr(client, "transport", None)
+        sock = transport.get_extra_info("socket") if transport is not None else None
+    if sock is None:
+        logging.warning("Modbus socket not found, TCP_NODELAY not set")
+        return False
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    except OSError as e:
+        logging.warning(f"Could not set TCP_NODELAY on the Modbus socket: {e}")
+        return False
+    return True
+
+def read_block(client, start, count, slave_id):
+    """Read count holding registers from start in one request, raises if the gateway does not answer."""
+    res = client.read_holding_registers(start, count, slave=slave_id)
+    if isinstance(res, ModbusIOException):
+        raise res  # no answer from the gateway, the caller reconnects
+    return res
+
+def read_register_groups(client, groups, slave_id):
+    """Read each register group in one request.
+
+    Returns (address -> values (None on error), set of addresses the UPS reports unavailable).
+    """
+    values = {}
+    unavailable = set()
+    for base, count, members in groups:
+        res = read_block(client, base, count, slave_id)
+        if not res or res.isError():
+            logging.error(f"Error reading registers 0x{base:04X}-0x{base + count - 1:04X}")
+            for address, offset, word_count in members:
+                values[address] = None
+            continue
+        # One vectorized compare per response, all words 0xFFFF means the UPS does not provide that value
+        unavail_mask = np.asarray(res.registers, dtype=np.uint16) == 0xFFFF
+        for address, offset, word_count in members:
+            values[address] = res.registers[offset:offset + word_count]
+            if unavail_mask[offset:offset + word_count].all():
+                unavailable.add(address)
+    return values, unavailable
+
+def read_ascii_string(client, start_addr, length, slave_id):
+    """Read multiple registers and decode as ASCII string (2 chars per register), None if it can not be read.
+
+    Used for optional values, so no reply is logged and returns None instead of raising like read_block.
+    """
+    res = client.read_holding_registers(start_addr, length, slave=slave_id)
+    if isinstance(res, ModbusIOException) or not res or res.isError():
+        logging.warning(f"Failed to read ASCII string at 0x{start_addr:04X}")
+        return None
+    raw = struct.pack(f">{len(res.registers)}H", *res.registers)
+    if raw.count(b'\xff') == len(raw):  # all words 0xFFFF, not provided by the UPS
+        logging.warning(f"Failed to read ASCII string at 0x{start_addr:04X}")
+        return None
+    string_val = raw.decode('ascii', errors='replace').strip('\x00').strip()
+    logging.info(f"Read ASCII string at 0x{start_addr:04X}: '{string_val}'")
+    return string_val
+
+class Poller:
+    """Reads the UPS over one persistent Modbus TCP connection and turns every poll into a sample dict."""
+
+    def __init__(self, cfg, quiet=False, status_texts=None, status_width=22):
+        """status_texts maps a STATUS_BITS key to (label, text when set, text when not set) for the console report,
+        keys that are left out use the STATUS_BITS texts. status_width is the width of the status labels."""
+        self.ip = cfg.get('MODBUS', 'ip_address')
+        self.port = cfg.getint('MODBUS', 'port')
+        self.slave_id = cfg.getint('MODBUS', 'slave_id')
+        # Keep one Modbus connection open across polls, only reconnect after it was lost
+        self.client = ModbusTcpClient(self.ip, port=self.port, timeout=5)
+        atexit.register(self.client.close)  # close the connection cleanly on shutdown
+        self.reconnect_delay = RECONNECT_DELAY_MIN
+        self.device_name = None
+        self.soc_history = SOCRing(600)
+        # quiet turns off the console report, the SOC graph is only drawn when a terminal is watching
+        self.quiet = quiet
+        self.render_graph = not quiet and sys.stdout.isatty()
+        self.last_graph_time = float('-inf')
+        # Status lines of the report as (key, padded label, text when set, text when not set)
+        status_texts = status_texts or {}
+        self.status_lines = []
+        for key, _, label, text_set, text_unset in STATUS_BITS:
+            if key in status_texts:
+                label, text_set, text_unset = status_texts[key]
+            self.status_lines.append((key, f"{label:<{status_width}}: ", text_set, text_unset))
+        self.device_name_prefix = f"{'Device Name':<{status_width}}: "
+
+    def connect(self):
+        """Open the connection if needed, returns False if the UPS can not be reached."""
+        if self.client.is_socket_open():
+            return True
+        if not self.client.connect():
+            print(f"MODBUS - Connection failed to {self.ip}:{self.port}")
+            logging.error(f"Modbus connection failed to {self.ip}:{self.port}, retrying in {self.reconnect_delay} s")
+            return False
+        enable_tcp_nodelay(self.client)
+        print(f"\nMODBUS - Connected to {self.ip}:{self.port}")
+        logging.info(f"Modbus connected to {self.ip}:{self.port} (Slave ID {self.slave_id})")
+        self.reconnect_delay = RECONNECT_DELAY_MIN
+        self.device_name = None  # read again, the gateway may now talk to another UPS
+        return True
+
+    def poll(self):
+        """Read all registers once and return a sample dict, or None if the UPS could not be read."""
+        if not self.connect():
+            return None
+
+        # Read the clock once per poll and reuse it everywhere below
+        now_wall = time.time()
+        now_mono = time.monotonic()
+
+        try:
+            # Status Functions (0x2000) is part of the 0x2000-0x203C block, so the status flags need no extra request
+            block_values, unavailable_addresses = read_register_groups(self.client, READ_GROUPS, self.slave_id)
+        except (ConnectionException, ModbusIOException, OSError) as e:
+            # Drop the broken connection, it is reopened at the start of the next poll
+            print(f"MODBUS - Connection error: {e}")
+            logging.error(f"Modbus connection error: {e}")
+            self.client.close()
+            return None
+
+        # Read Device Name (0x0012) just to have it, it never changes so once per connection is enough.
+        # It is optional and read after the registers, so a failed read only costs the name, never the sample.
+        if self.device_name is None:
+            try:
+                self.device_name = read_ascii_string(self.client, 0x0012, 2, self.slave_id) or "UnknownDevice"
+            except (ConnectionException, OSError) as e:
+                logging.warning(f"Device name read failed: {e}")
+                self.device_name = "UnknownDevice"
+
+        status_functions = block_values[0x2000]
+        if status_functions is not None:
+            status_flags = decode_status_bits(status_functions)
+            logging.info("Status registers read: " + ", ".join(f"{key}={value}" for key, value in status_flags.items()))
+        else:
+            status_flags = {key: False for key, *_ in STATUS_BITS}
+            logging.warning("Status registers unavailable")
+
+        # Raw words, unavailable labels (0xFFFF) and the decoded value of every register in one generated pass
+        register_values, unavailable, results = decode_registers(block_values, unavailable_addresses)
+
+        soc = None
+        battery_voltage = results["Battery Voltage"]
+        if battery_voltage is not None:
+            # Linear SOC estimate from voltage, clamp 0-100%
+            soc = (battery_voltage - _SOC_V_MIN) * _SOC_INV_RANGE
+            soc = 0.0 if soc < 0 else (100.0 if soc > 100 else soc)
+            self.soc_history.append(now_mono, soc)  # monotonic, the graph window relies on sorted times
+            logging.info(f"Calculated SOC: {soc:.2f}%")
+        else:
+            logging.warning("Battery Voltage unavailable, cannot calculate SOC")
+
+        return {
+            "monotonic": now_mono,
+            "timestamp": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now_wall)),
+            "device_name": self.device_name,
+            **status_flags,
+            "registers": register_values,
+            "unavailable": unavailable,
+            "battery_voltage": battery_voltage,  # V
+            "soc": soc,  # %
+            "output_current": results["Output Current"],  # mA
+            "battery_current": results["Battery Current"],  # mA
+            "battery_temperature": results["Battery Temperature"],  # °C
+            "device_temperature": results["Device Temperature"],  # °C
+        }
+
+    def stream(self, interval=None):
+        """Poll forever and yield every sample, waiting interval seconds in between (default 5 s on battery, 10 s on mains)."""
+        while True:
+            if not self.connect():
+                time.sleep(self.reconnect_delay)
+                self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_DELAY_MAX)
+                continue
+            try:
+                sample = self.poll()
+            except Exception as e:
+                print(f"Unexpected error: {e}")
+                logging.exception("Unexpected error occurred")
+                sample = None
+            if sample is not None:
+                yield sample
+            if interval is not None:
+                wait_time = interval
+            else:
+                # Wait 5 seconds if battery mode active, else 10 seconds
+                wait_time = 5 if sample and sample["battery_mode"] else 10
+            print(f"\nWaiting {wait_time} seconds...\n{'='*60}")
+            time.sleep(wait_time)
+
+    def print_report(self, sample):
+        """Print status flags, all register values, the SOC estimate and the SOC trend graph of a sample.
+
+        Nothing is printed in quiet mode, the graph only on a terminal and at most every GRAPH_INTERVAL seconds.
+        """
+        if self.quiet:
+            return
+        for key, prefix, text_set, text_unset in self.status_lines:
+            print(prefix + (text_set if sample[key] else text_unset))
+        print(self.device_name_prefix + sample['device_name'])
+
+        for spec in REGISTER_SPECS:
+            values = sample["registers"][spec.label]
+            if values is None:
+                print(f"{spec.label:<35}: ERROR reading")
+            elif spec.label in sample["unavailable"]:
+                print(f"{spec.label:<35}: Unavailable")
+            else:
+                print(spec.formatter(values))
+
+        if sample["soc"] is not None:
+            print(f"\nEstimated Battery SOC  : {sample['soc']:.2f}% (Voltage: {sample['battery_voltage']:.2f} V)")
+        else:
+            print("\nEstimated Battery SOC  : N/A (Battery Voltage not available)")
+        if self.render_graph and sample["monotonic"] - self.last_graph_time >= GRAPH_INTERVAL:
+            self.last_graph_time = sample["monotonic"]
+            print_soc_graph(self.soc_history, sample["monotonic"])